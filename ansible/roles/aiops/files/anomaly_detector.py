@@ -7,111 +7,206 @@ AIOps 异常检测系统
 import json
 import logging
 import os
+import time
 from datetime import datetime
+from string import Template
 
 import numpy as np
 import pandas as pd
-import requests
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 
+from event_log import setup_logging
+from model_registry import ModelRegistry
+from prom_cache import PromQueryCache, align
+from sharding import ShardConfig
+
 # === 配置 ===
 PROM_URL = os.getenv("PROMETHEUS_URL", "http://localhost:9090")
-HISTORY_FILE = "/opt/monitoring/aiops/metrics_history.csv"
-ANOMALY_SCORE_FILE = "/opt/monitoring/aiops/anomaly_score.txt"
-LOG_FILE = "/opt/monitoring/aiops/aiops.log"
-MAX_HISTORY = 200  # 保留历史数据点数量
+SHARD = ShardConfig()
+DATA_DIR = SHARD.data_dir()  # 本分片的数据目录，单节点时即 AIOps 根目录
+ANOMALY_SCORE_FILE = os.path.join(DATA_DIR, "anomaly_score.txt")
+ANOMALY_SCORES_FILE = os.path.join(DATA_DIR, "anomaly_scores.json")
+SHADOW_SCORES_FILE = os.path.join(DATA_DIR, "shadow_scores.json")  # 候选模型的影子评分
+LOG_FILE = os.path.join(DATA_DIR, "aiops.log")
+MAX_HISTORY = 200  # 历史数据点数量，间隔为缓存 step（PROM_CACHE_STEP，默认与 5 分钟的 cron 周期一致）
+MODEL_RETRAIN_INTERVAL = int(os.getenv("AIOPS_MODEL_RETRAIN_INTERVAL", "3600"))  # 模型重新训练间隔（秒）
+MODEL_AUTO_PROMOTE = os.getenv("AIOPS_MODEL_AUTO_PROMOTE", "true").lower() == "true"  # 否则新模型仅作为候选做影子评分
+
+FEATURES = ["cpu_usage", "memory_usage", "disk_usage", "network_rx"]
+
+# 按 instance 聚合的基础指标查询，$shard 替换为本分片实例的标签匹配器
+QUERIES = {
+    "cpu_usage": '100 - (avg by (instance) (rate(node_cpu_seconds_total{mode="idle",$shard}[5m])) * 100)',
+    "memory_usage": '(1 - (node_memory_MemAvailable_bytes{$shard} / node_memory_MemTotal_bytes{$shard})) * 100',
+    "disk_usage": '(1 - (node_filesystem_avail_bytes{mountpoint="/",$shard} / node_filesystem_size_bytes{mountpoint="/",$shard})) * 100',
+    "network_rx": 'sum by (instance) (rate(node_network_receive_bytes_total{$shard}[5m]))',
+}
+INSTANCES_QUERY = "count by (instance) (node_memory_MemTotal_bytes)"  # 分片时发现全部被监控实例
+
+os.makedirs(DATA_DIR, exist_ok=True)
 
 # === 日志配置 ===
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+setup_logging(LOG_FILE)
 
 
 class AIOpsAnomalyDetector:
     def __init__(self, prometheus_url=PROM_URL):
         self.prometheus_url = prometheus_url
+        self.shadow_scores = {}
+        self.cache = PromQueryCache(
+            prometheus_url,
+            cache_file=os.path.join(DATA_DIR, "prom_cache.json"),
+            stats_file=os.path.join(DATA_DIR, "prom_cache_stats.json"),
+        )
+
+    def discover_instances(self):
+        """列出全部被监控实例（经缓存的即时查询，每个实例只返回一个序列）"""
+        try:
+            return [series["metric"].get("instance", "") for series in self.cache.query(INSTANCES_QUERY)]
+        except Exception as e:
+            logging.warning(f"Prometheus 查询失败: {INSTANCES_QUERY} ({e})")
+            return []
 
-    def query_metric(self, query):
-        """查询 Prometheus 指标"""
+    def query_metric_range(self, query, start, end, step=None):
+        """区间查询 Prometheus 指标（经缓存，只拉取缺失时间段）"""
         try:
-            resp = requests.get(f"{self.prometheus_url}/api/v1/query", params={"query": query}, timeout=10)
-            data = resp.json()
-            return float(data["data"]["result"][0]["value"][1])
+            return self.cache.query_range(query, start, end, step)
         except Exception as e:
-            logging.warning(f"Prometheus 查询失败: {query} ({e})")
-            return np.nan
-
-    def collect_metrics(self):
-        """收集基础指标"""
-        metrics = {
-            "cpu_usage": self.query_metric('100 - (avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[5m])) * 100)'),
-            "memory_usage": self.query_metric('(1 - (node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes)) * 100'),
-            "disk_usage": self.query_metric('(1 - (node_filesystem_avail_bytes{mountpoint="/"} / node_filesystem_size_bytes{mountpoint="/"})) * 100'),
-            "network_rx": self.query_metric('rate(node_network_receive_bytes_total[5m])')
-        }
-        return metrics
-
-    def update_history(self, new_metrics):
-        """更新历史指标数据"""
-        df_new = pd.DataFrame([new_metrics])
-        df_new["timestamp"] = datetime.now()
-
-        if os.path.exists(HISTORY_FILE):
-            df = pd.read_csv(HISTORY_FILE)
-            df = pd.concat([df, df_new], ignore_index=True)
-            df = df.tail(MAX_HISTORY)
-        else:
-            df = df_new
+            logging.warning(f"Prometheus 区间查询失败: {query} ({e})")
+            return []
+
+    def collect_history(self, end):
+        """
+        用区间查询构建本分片内各实例最近 MAX_HISTORY 个周期的历史数据，返回 {instance: DataFrame}；
+        分片过滤下推到 PromQL，只查询与缓存本分片的序列；区间查询经缓存，每轮只向 Prometheus 拉取最新的时间段。
+        本分片的实例集合变化时查询文本随之变化，需重新拉取完整窗口，旧的缓存条目在保留跨度后过期
+        """
+        matcher = SHARD.matcher(self.discover_instances() if SHARD.enabled else [])
+        if matcher is None:
+            return {}
+
+        step = self.cache.step
+        start = end - step * (MAX_HISTORY - 1)
+        points = {}  # instance -> {ts: {feature: value}}
+        for name, query in QUERIES.items():
+            query = Template(query).substitute(shard=matcher)
+            for series in self.query_metric_range(query, start, end, step):
+                instance = series["metric"].get("instance", "")
+                for t, v in series["values"]:
+                    points.setdefault(instance, {}).setdefault(int(t), {})[name] = float(v)
+
+        history = {}
+        for instance in sorted(points):
+            df = pd.DataFrame.from_dict(points[instance], orient="index").reindex(columns=FEATURES).sort_index()
+            df["timestamp"] = [datetime.fromtimestamp(t) for t in df.index]
+            history[instance] = df.reset_index(drop=True)
+        return history
+
+    def train_model(self, registry, df, promote=True):
+        """训练 IsolationForest 并保存为注册表中的新版本，promote 为 False 时作为候选模型"""
+        scaler = StandardScaler()
+        X = scaler.fit_transform(df[FEATURES])
 
-        df.to_csv(HISTORY_FILE, index=False)
-        return df
+        model = IsolationForest(contamination=0.1, random_state=42)
+        model.fit(X)
+
+        version = registry.save(scaler, model, FEATURES, {
+            "start": str(df["timestamp"].iloc[0]) if "timestamp" in df else None,
+            "end": str(df["timestamp"].iloc[-1]) if "timestamp" in df else None,
+            "rows": len(df),
+        })
+        if promote:
+            registry.promote(version)
+        else:
+            registry.set_candidate(version)
+        return version
 
-    def detect_anomalies(self, df):
-        """使用 IsolationForest 检测异常"""
+    def load_model(self, loader):
+        """加载模型快照，快照损坏或特征 schema 不一致时返回 None"""
+        try:
+            model = loader()
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"模型快照加载失败 ({e})")
+            return None
+        if model is not None and model.features != FEATURES:
+            return None
+        return model
+
+    def detect_anomalies(self, df, instance=""):
+        """使用注册表中激活的 IsolationForest 模型检测异常，候选模型做影子评分"""
         if len(df) < 10:
             return 0.0  # 数据太少，不判断异常
 
-        features = ["cpu_usage", "memory_usage", "disk_usage", "network_rx"]
-        df = df.dropna(subset=features)
+        df = df.dropna(subset=FEATURES)
+        registry = ModelRegistry.for_instance(instance, DATA_DIR)
 
-        scaler = StandardScaler()
-        X = scaler.fit_transform(df[features])
+        model = self.load_model(registry.load_active)
+        last_trained = registry.last_trained()
+        if model is None or last_trained is None or \
+                (datetime.now() - last_trained).total_seconds() > MODEL_RETRAIN_INTERVAL:
+            # 手动回滚后新模型只作为候选，避免定时重训把回滚撤销
+            auto_promote = MODEL_AUTO_PROMOTE and not registry.rolled_back()
+            self.train_model(registry, df, promote=auto_promote or model is None)
+            model = self.load_model(registry.load_active)
 
-        model = IsolationForest(contamination=0.1, random_state=42)
-        preds = model.fit_predict(X)
-        score = (preds == -1).mean()  # 异常比例
+        X = df[FEATURES].to_numpy()
+        score = (model.predict(X) == -1).mean()  # 异常比例
+
+        candidate = self.load_model(registry.load_candidate)
+        if candidate is not None:
+            self.shadow_scores[instance] = float((candidate.predict(X) == -1).mean())
 
         return float(score)
 
     def run(self):
         logging.info("开始异常检测...")
-        metrics = self.collect_metrics()
-        if any(np.isnan(list(metrics.values()))):
-            logging.warning("部分指标获取失败，跳过本轮检测")
+        end = time.time()
+        history = self.collect_history(end)
+        self.cache.save()
+        if not history:
+            logging.warning("本分片没有可检测的实例，跳过本轮检测")
             return
 
-        df = self.update_history(metrics)
-        score = self.detect_anomalies(df)
+        # 成员变化后删除已归属其他节点的模型；新接管的实例由本节点重新训练
+        SHARD.release("models")
+
+        latest = datetime.fromtimestamp(align(end, self.cache.step))
+        scores = {}
+        metrics_by_instance = {}
+        for instance, df in history.items():
+            last = df.iloc[-1]
+            metrics = {name: float(last[name]) for name in FEATURES}
+            if last["timestamp"] != latest or any(np.isnan(list(metrics.values()))):
+                logging.warning(f"{instance} 部分指标获取失败，跳过本轮检测")
+                continue
+            metrics_by_instance[instance] = metrics
+            scores[instance] = self.detect_anomalies(df, instance)
+
+        if not scores:
+            return
 
+        score = max(scores.values())
         with open(ANOMALY_SCORE_FILE, "w") as f:
             f.write(str(round(score, 4)))
-
-        logging.info(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "anomaly_score": score,
-            "metrics": metrics
-        }, ensure_ascii=False))
-
-        if score > 0.5:
-            logging.warning(f"⚠️ 检测到异常 (score={score:.2f})")
+        with open(ANOMALY_SCORES_FILE, "w") as f:
+            json.dump({i: round(s, 4) for i, s in scores.items()}, f)
+        with open(SHADOW_SCORES_FILE, "w") as f:
+            json.dump({i: round(s, 4) for i, s in self.shadow_scores.items()}, f)
+
+        logging.info("detection", extra={
+            "shard": SHARD.shard_id or None,
+            "anomaly_scores": scores,
+            "shadow_scores": self.shadow_scores,
+            "metrics": metrics_by_instance
+        })
+
+        anomalous = {i: s for i, s in scores.items() if s > 0.5}
+        if anomalous:
+            for instance, s in anomalous.items():
+                logging.warning(f"⚠️ 检测到异常 {instance} (score={s:.2f})")
         else:
-            logging.info("系统运行正常")
+            logging.info("系统运行正常", extra={"rate_limit": True})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+AIOps 日志管道
+日志记录经 QueueHandler 入队，由后台 QueueListener 线程写出紧凑的 NDJSON 事件，
+日志文件按大小/时间轮转并 gzip 压缩，重复的常规消息按时间窗口限流
+"""
+
+import atexit
+import copy
+import gzip
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# === 配置 ===
+LOG_MAX_BYTES = int(os.getenv("AIOPS_LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个日志文件大小上限
+LOG_MAX_AGE = int(os.getenv("AIOPS_LOG_MAX_AGE", "86400"))  # 单个日志文件最长时间跨度（秒）
+LOG_BACKUP_COUNT = int(os.getenv("AIOPS_LOG_BACKUP_COUNT", "7"))  # 保留的压缩归档数
+LOG_RATE_LIMIT_WINDOW = int(os.getenv("AIOPS_LOG_RATE_LIMIT_WINDOW", "3600"))  # 限流消息的最小输出间隔（秒）
+LOG_STDERR = os.getenv("AIOPS_LOG_STDERR", "true").lower() == "true"
+
+# LogRecord 自带的属性，其余属性视为 extra 传入的事件字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "rate_limit"}
+
+
+def _finite(value):
+    """把 NaN/Inf 替换为 None（JSON null），保证输出为合法 JSON"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(v) for v in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为单行 JSON，extra 中的字段并入事件"""
+
+    def format(self, record):
+        event = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        event.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(_finite(event), ensure_ascii=False, separators=(",", ":"), allow_nan=False, default=str)
+
+
+class EventQueueHandler(QueueHandler):
+    """
+    入队前只合并 msg/args 并预先渲染异常堆栈（exc_text），不做格式化；
+    标准 QueueHandler.prepare 会在调用方线程格式化整条记录并清空 exc_info
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None  # 不跨线程持有 traceback 帧
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    对带 rate_limit 标记的记录限流：同一消息在窗口内只输出一次，
+    被抑制的次数附在下一次输出的记录上；状态落盘以便跨 cron 进程生效
+    """
+
+    def __init__(self, window=LOG_RATE_LIMIT_WINDOW, state_file=None):
+        super().__init__()
+        self.window = window
+        self.state_file = state_file
+        self.state = {}
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file, "r") as f:
+                    self.state = json.load(f)
+            except Exception:
+                self.state = {}
+
+    def filter(self, record):
+        if not getattr(record, "rate_limit", False):
+            return True
+        key = record.getMessage()
+        last, suppressed = self.state.get(key, (0.0, 0))
+        if record.created - last < self.window:
+            self.state[key] = (last, suppressed + 1)
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+        self.state[key] = (record.created, 0)
+        return True
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp, self.state_file)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """按大小或时间跨度轮转的文件日志，归档文件 gzip 压缩"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE, backup_count=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.max_age = max_age
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = self._gzip_rotator
+        self.started_at = self._first_record_time()
+
+    def _first_record_time(self):
+        """取当前日志文件第一条事件的时间，作为时间轮转的起点"""
+        try:
+            with open(self.baseFilename, "r", encoding="utf-8") as f:
+                first = json.loads(f.readline())
+            return datetime.fromisoformat(first["ts"]).timestamp()
+        except Exception:
+            return time.time()
+
+    def shouldRollover(self, record):
+        if self.max_age and record.created - self.started_at >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.started_at = time.time()
+
+    @staticmethod
+    def _gzip_rotator(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+def setup_logging(log_file, level=logging.INFO, stderr=LOG_STDERR):
+    """
+    配置根 logger：调用方只做限流判断与入队，格式化、写文件与轮转压缩都在监听线程中完成；
+    进程退出时排空队列并保存限流状态
+    """
+    rate_limit = RateLimitFilter(state_file=os.path.join(os.path.dirname(log_file), "log_ratelimit.json"))
+
+    handlers = [CompressedRotatingFileHandler(log_file)]
+    if stderr:
+        handlers.append(logging.StreamHandler())
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # 限流在入队前完成，被抑制的记录不进入队列
+    log_queue = queue.SimpleQueue()
+    queue_handler = EventQueueHandler(log_queue)
+    queue_handler.addFilter(rate_limit)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [queue_handler]
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def shutdown():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+        rate_limit.save()
+
+    atexit.register(shutdown)
+    return listener
@@ -4,15 +4,136 @@ Custom Prometheus Metrics Exporter
 为 AIOps 提供系统与自定义指标
 """
 
+import heapq
+import json
 import os
 import random
 import signal
+import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import psutil
 
+from sharding import ShardConfig
+
 PORT = int(os.getenv("EXPORTER_PORT", "8000"))
-ANOMALY_SCORE_FILE = "/opt/monitoring/aiops/anomaly_score.txt"
+DATA_DIR = ShardConfig().data_dir()  # 只导出本分片的检测结果
+ANOMALY_SCORE_FILE = os.path.join(DATA_DIR, "anomaly_score.txt")
+ANOMALY_SCORES_FILE = os.path.join(DATA_DIR, "anomaly_scores.json")
+SHADOW_SCORES_FILE = os.path.join(DATA_DIR, "shadow_scores.json")
+PROM_CACHE_STATS_FILE = os.path.join(DATA_DIR, "prom_cache_stats.json")
+PROCESS_TOP_N = int(os.getenv("EXPORTER_PROCESS_TOP_N", "10"))  # 每个维度导出的进程数上限
+PROCESS_FULL_REFRESH = int(os.getenv("EXPORTER_PROCESS_FULL_REFRESH", "10"))  # 空闲进程每隔多少次扫描完整读取一次
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _read_stat(pid):
+    """读取一次 /proc/<pid>/stat，返回 (starttime, 累计 CPU 秒数)；starttime 为开机后的 tick 数"""
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        fields = f.read().rsplit(b")", 1)[1].split()  # 进程名可能包含空格和括号
+    return int(fields[19]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+class ProcessScanner:
+    """
+    增量进程扫描器：每个进程每次扫描只读取一次 /proc/<pid>/stat，取累计 CPU 时间与启动时间，
+    按 (pid, starttime) 跨扫描缓存 psutil.Process 句柄与进程名，PID 被复用时视为新进程；
+    用两次抓取之间的累计值差计算 CPU 与 IO 速率，不需要逐进程 interval 等待；
+    自上次扫描以来没有消耗 CPU 的进程沿用缓存的 RSS 与 IO，每 PROCESS_FULL_REFRESH 次扫描完整刷新一次，
+    IO 速率按距上次完整读取的时间计算
+    """
+
+    def __init__(self, top_n=PROCESS_TOP_N):
+        self.top_n = top_n
+        self._procs = {}  # (pid, starttime) -> {"proc", "name", "cpu", "rss", "io", "io_at", "idle"}
+        self._last_scan = None
+        self.process_count = 0
+        self.scan_seconds = 0.0
+
+    def scan(self):
+        """扫描全部进程，返回 [(name, cpu_percent, rss_bytes, io_bytes_per_second)]"""
+        start = time.monotonic()
+        elapsed = start - self._last_scan if self._last_scan else None
+        pids = psutil.pids()
+
+        procs = {}
+        samples = []
+        for pid in pids:
+            try:
+                starttime, cpu_total = _read_stat(pid)
+            except (OSError, IndexError, ValueError):
+                continue  # 进程已退出
+            key = (pid, starttime)
+            entry = self._procs.get(key)
+            try:
+                if entry is None:
+                    proc = psutil.Process(pid)
+                    entry = {"proc": proc, "name": proc.name(), "cpu": None, "rss": 0, "io": None, "io_at": None, "idle": 0}
+                procs[key] = entry
+
+                cpu_percent = 0.0
+                if elapsed and entry["cpu"] is not None:
+                    cpu_percent = (cpu_total - entry["cpu"]) / elapsed * 100
+                if cpu_total == entry["cpu"] and entry["idle"] < PROCESS_FULL_REFRESH:
+                    entry["idle"] += 1
+                    samples.append((entry["name"], 0.0, entry["rss"], 0.0))
+                    continue
+                entry["idle"] = 0
+                entry["cpu"] = cpu_total
+
+                proc = entry["proc"]
+                with proc.oneshot():
+                    rss = proc.memory_info().rss
+                    try:
+                        io = proc.io_counters()
+                        io_total = io.read_bytes + io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        io_total = None  # 非 root 无法读取其他用户进程的 IO
+            except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+                procs.pop(key, None)
+                continue
+
+            io_rate = 0.0
+            if io_total is not None and entry["io"] is not None and io_total >= entry["io"] and start > entry["io_at"]:
+                io_rate = (io_total - entry["io"]) / (start - entry["io_at"])
+            entry["rss"], entry["io"], entry["io_at"] = rss, io_total, start
+            samples.append((entry["name"], cpu_percent, rss, io_rate))
+
+        self._procs = procs  # 已退出或 PID 被复用的旧条目随之丢弃
+        self._last_scan = start
+        self.process_count = len(pids)
+        self.scan_seconds = time.monotonic() - start
+        return samples
+
+    def collect_metrics(self):
+        """按 CPU、RSS、IO 分别导出 top-N 进程，标签只有 rank 与 name 以限制序列基数"""
+        samples = self.scan()
+        sections = []
+        for metric, help_text, index in [
+            ("aiops_process_cpu_percent", "CPU usage percent of top processes by CPU", 1),
+            ("aiops_process_rss_bytes", "Resident memory of top processes by RSS", 2),
+            ("aiops_process_io_bytes_per_second", "Disk read+write rate of top processes by IO", 3),
+        ]:
+            # 只对非零样本排名，避免空闲进程按扫描顺序轮流占位造成序列抖动
+            top = heapq.nlargest(self.top_n, [s for s in samples if s[index] > 0], key=lambda sample: sample[index])
+            lines = [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [
+                f'{metric}{{rank="{rank}",name="{_escape_label(sample[0])}"}} {round(sample[index], 3)}'
+                for rank, sample in enumerate(top, 1)
+            ]
+            sections.append("\n".join(lines))
+
+        sections.append(f"""# HELP aiops_process_scan_seconds Duration of the last process scan
+# TYPE aiops_process_scan_seconds gauge
+aiops_process_scan_seconds {round(self.scan_seconds, 6)}""")
+        return "\n\n".join(sections) + "\n"
+
+
+PROCESS_SCANNER = ProcessScanner()
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
@@ -36,7 +157,8 @@ class MetricsHandler(BaseHTTPRequestHandler):
         cpu_percent = psutil.cpu_percent(interval=0.1)
         mem = psutil.virtual_memory()
         disk = psutil.disk_usage("/")
-        process_count = len(psutil.pids())
+        process_metrics = PROCESS_SCANNER.collect_metrics()
+        process_count = PROCESS_SCANNER.process_count
         net_conn = len(psutil.net_connections())
 
         # 模拟自定义业务指标
@@ -51,6 +173,41 @@ class MetricsHandler(BaseHTTPRequestHandler):
             except Exception:
                 pass
 
+        # 本分片各实例的异常分数（若存在）
+        instance_scores = {}
+        if os.path.exists(ANOMALY_SCORES_FILE):
+            try:
+                with open(ANOMALY_SCORES_FILE, "r") as f:
+                    instance_scores = json.load(f)
+            except Exception:
+                pass
+        instance_score_lines = "\n".join(
+            f'aiops_instance_anomaly_score{{instance="{_escape_label(instance)}"}} {score}'
+            for instance, score in sorted(instance_scores.items())
+        )
+
+        # 候选模型的影子评分（若存在）
+        shadow_scores = {}
+        if os.path.exists(SHADOW_SCORES_FILE):
+            try:
+                with open(SHADOW_SCORES_FILE, "r") as f:
+                    shadow_scores = json.load(f)
+            except Exception:
+                pass
+        shadow_score_lines = "\n".join(
+            f'aiops_instance_shadow_anomaly_score{{instance="{_escape_label(instance)}"}} {score}'
+            for instance, score in sorted(shadow_scores.items())
+        )
+
+        # Prometheus 查询缓存统计（若存在）
+        cache_stats = {}
+        if os.path.exists(PROM_CACHE_STATS_FILE):
+            try:
+                with open(PROM_CACHE_STATS_FILE, "r") as f:
+                    cache_stats = json.load(f)
+            except Exception:
+                pass
+
         metrics = f"""
 # HELP system_load_average System load average
 # TYPE system_load_average gauge
@@ -74,6 +231,7 @@ disk_usage_percent {disk.percent}
 # TYPE system_process_count gauge
 system_process_count {process_count}
 
+{process_metrics}
 # HELP system_network_connections Active network connections
 # TYPE system_network_connections gauge
 system_network_connections {net_conn}
@@ -85,6 +243,34 @@ custom_application_metric {custom_metric}
 # HELP aiops_anomaly_score AIOps anomaly score (0-1)
 # TYPE aiops_anomaly_score gauge
 aiops_anomaly_score {anomaly_score}
+
+# HELP aiops_instance_anomaly_score AIOps anomaly score per monitored instance in this shard (0-1)
+# TYPE aiops_instance_anomaly_score gauge
+{instance_score_lines}
+
+# HELP aiops_instance_shadow_anomaly_score Anomaly score from the candidate model under shadow evaluation (0-1)
+# TYPE aiops_instance_shadow_anomaly_score gauge
+{shadow_score_lines}
+
+# HELP aiops_prom_cache_hits_total Prometheus query cache hits
+# TYPE aiops_prom_cache_hits_total counter
+aiops_prom_cache_hits_total {cache_stats.get("hits", 0)}
+
+# HELP aiops_prom_cache_partial_hits_total Prometheus range query cache partial hits
+# TYPE aiops_prom_cache_partial_hits_total counter
+aiops_prom_cache_partial_hits_total {cache_stats.get("partial_hits", 0)}
+
+# HELP aiops_prom_cache_misses_total Prometheus query cache misses
+# TYPE aiops_prom_cache_misses_total counter
+aiops_prom_cache_misses_total {cache_stats.get("misses", 0)}
+
+# HELP aiops_prom_cache_evictions_total Prometheus query cache evictions (instant entries and range time buckets)
+# TYPE aiops_prom_cache_evictions_total counter
+aiops_prom_cache_evictions_total {cache_stats.get("evictions", 0)}
+
+# HELP aiops_prom_cache_bytes Prometheus query cache estimated size in bytes
+# TYPE aiops_prom_cache_bytes gauge
+aiops_prom_cache_bytes {cache_stats.get("bytes", 0)}
 """
         return metrics
 
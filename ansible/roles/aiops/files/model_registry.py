@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+AIOps 模型注册表
+保存带版本号与校验和的模型快照（标准化参数、IsolationForest 树结构、特征 schema、训练窗口），
+快照为一组 .npy 文件，加载时直接内存映射而不是反序列化 pickle；
+支持原子 promote/rollback，以及候选模型与当前模型并行的影子评分
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from sharding import ShardConfig, instance_key
+
+# === 配置 ===
+MODEL_KEEP_VERSIONS = int(os.getenv("AIOPS_MODEL_KEEP_VERSIONS", "10"))  # 每个实例保留的历史版本数
+MODEL_HISTORY_DEPTH = 5  # 可回滚的激活记录深度
+
+_ARRAYS = ["scaler_mean", "scaler_scale", "tree_offsets", "left", "right", "feature", "threshold", "n_samples"]
+
+
+def _average_path_length(n):
+    """与 sklearn.ensemble._iforest._average_path_length 一致的平均路径长度"""
+    n = np.asarray(n, dtype=np.float64)
+    result = np.zeros_like(n)
+    result[n == 2] = 1.0
+    mask = n > 2
+    result[mask] = 2.0 * (np.log(n[mask] - 1.0) + np.euler_gamma) - 2.0 * (n[mask] - 1.0) / n[mask]
+    return result
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ModelSnapshot:
+    """内存映射加载的模型快照，评分逻辑与 StandardScaler + IsolationForest 等价"""
+
+    def __init__(self, path, meta, arrays):
+        self.path = path
+        self.meta = meta
+        self.version = meta["version"]
+        self.features = meta["features"]
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, path, verify=True):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in _ARRAYS:
+            file_path = os.path.join(path, f"{name}.npy")
+            if verify and _sha256(file_path) != meta["checksums"][name]:
+                raise ValueError(f"模型快照校验失败: {file_path}")
+            arrays[name] = np.load(file_path, mmap_mode="r")
+        return cls(path, meta, arrays)
+
+    def score_samples(self, X):
+        """IsolationForest.score_samples 的等价实现，X 为未标准化的原始特征"""
+        a = self.arrays
+        X = ((np.asarray(X, dtype=np.float64) - a["scaler_mean"]) / a["scaler_scale"]).astype(np.float32)
+        rows = np.arange(len(X))
+        depths = np.zeros(len(X))
+        offsets = a["tree_offsets"]
+
+        for t in range(len(offsets) - 1):
+            base = offsets[t]
+            node = np.full(len(X), base, dtype=np.int64)
+            depth = np.zeros(len(X))
+            active = a["left"][node] != -1
+            while active.any():
+                idx = node[active]
+                go_left = X[rows[active], a["feature"][idx]] <= a["threshold"][idx]
+                node[active] = base + np.where(go_left, a["left"][idx], a["right"][idx])
+                depth[active] += 1
+                active = a["left"][node] != -1
+            depths += depth + _average_path_length(a["n_samples"][node])
+
+        n_trees = len(offsets) - 1
+        denominator = n_trees * _average_path_length([self.meta["max_samples"]])[0]
+        return -(2 ** (-depths / denominator))
+
+    def predict(self, X):
+        """-1 表示异常，1 表示正常"""
+        return np.where(self.score_samples(X) - self.meta["offset"] < 0, -1, 1)
+
+
+class ModelRegistry:
+    """单个实例的模型注册表，目录结构为 versions/<version>/ + registry.json"""
+
+    def __init__(self, root):
+        self.root = root
+        self.versions_dir = os.path.join(root, "versions")
+        self.state_file = os.path.join(root, "registry.json")
+
+    @classmethod
+    def for_instance(cls, instance, data_dir=None):
+        data_dir = data_dir or ShardConfig().data_dir()
+        return cls(os.path.join(data_dir, "models", instance_key(instance)))
+
+    # --- 状态 ---
+
+    def state(self):
+        if not os.path.exists(self.state_file):
+            return {"active": None, "candidate": None, "previous": []}
+        with open(self.state_file, "r") as f:
+            return json.load(f)
+
+    def _write_state(self, state):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def versions(self):
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted(v for v in os.listdir(self.versions_dir) if not v.startswith("."))
+
+    def last_trained(self):
+        """最近一次保存快照的时间，没有快照或元数据损坏时返回 None（调用方据此重新训练）"""
+        versions = self.versions()
+        if not versions:
+            return None
+        try:
+            with open(os.path.join(self.versions_dir, versions[-1], "meta.json"), "r") as f:
+                return datetime.fromisoformat(json.load(f)["created_at"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"模型元数据读取失败: {versions[-1]} ({e})")
+            return None
+
+    def rolled_back(self):
+        """手动回滚后到下一次显式激活之前返回回滚时间，期间新训练的模型只作为候选，不自动激活"""
+        return self.state().get("rolled_back_at")
+
+    # --- 保存 ---
+
+    def save(self, scaler, model, features, window):
+        """把已训练的 StandardScaler + IsolationForest 保存为新版本快照，返回版本号"""
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        tmp_dir = os.path.join(self.versions_dir, f".tmp-{version}")
+        os.makedirs(tmp_dir)
+
+        trees = [est.tree_ for est in model.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees]).astype(np.int64)
+        # 把每棵树在特征子集中的下标映射回全量特征下标
+        feature = np.concatenate([
+            np.where(tree.feature >= 0, np.asarray(est_features)[np.maximum(tree.feature, 0)], -2)
+            for tree, est_features in zip(trees, model.estimators_features_)
+        ]).astype(np.int64)
+        arrays = {
+            "scaler_mean": np.asarray(scaler.mean_, dtype=np.float64),
+            "scaler_scale": np.asarray(scaler.scale_, dtype=np.float64),
+            "tree_offsets": offsets,
+            "left": np.concatenate([tree.children_left for tree in trees]).astype(np.int64),
+            "right": np.concatenate([tree.children_right for tree in trees]).astype(np.int64),
+            "feature": feature,
+            "threshold": np.concatenate([tree.threshold for tree in trees]).astype(np.float64),
+            "n_samples": np.concatenate([tree.n_node_samples for tree in trees]).astype(np.int64),
+        }
+
+        checksums = {}
+        for name, array in arrays.items():
+            file_path = os.path.join(tmp_dir, f"{name}.npy")
+            np.save(file_path, np.ascontiguousarray(array))
+            checksums[name] = _sha256(file_path)
+
+        meta = {
+            "version": version,
+            "created_at": datetime.now().isoformat(),
+            "features": list(features),
+            "training_window": window,
+            "params": {k: v for k, v in model.get_params().items() if isinstance(v, (int, float, str, type(None)))},
+            "max_samples": int(model.max_samples_),
+            "offset": float(model.offset_),
+            "checksums": checksums,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        os.replace(tmp_dir, os.path.join(self.versions_dir, version))
+        return version
+
+    # --- 加载 ---
+
+    def load(self, version, verify=True):
+        return ModelSnapshot.load(os.path.join(self.versions_dir, version), verify=verify)
+
+    def load_active(self):
+        version = self.state()["active"]
+        return self.load(version) if version else None
+
+    def load_candidate(self):
+        version = self.state()["candidate"]
+        return self.load(version) if version else None
+
+    # --- promote / rollback ---
+
+    def set_candidate(self, version):
+        """设置影子评分的候选模型"""
+        state = self.state()
+        state["candidate"] = version
+        self._write_state(state)
+        self.prune()
+
+    def promote(self, version=None):
+        """激活指定版本（默认当前候选模型），原激活版本进入回滚记录"""
+        state = self.state()
+        version = version or state["candidate"]
+        if version not in self.versions():
+            raise ValueError(f"模型版本不存在: {version}")
+        if state["active"] and state["active"] != version:
+            state["previous"] = ([state["active"]] + state["previous"])[:MODEL_HISTORY_DEPTH]
+        state["active"] = version
+        if state["candidate"] == version:
+            state["candidate"] = None
+        state.pop("rolled_back_at", None)
+        self._write_state(state)
+        self.prune()
+        logging.info(f"模型已激活: {self.root} -> {version}")
+        return version
+
+    def rollback(self):
+        """回滚到上一个激活版本，并暂停自动激活直到下一次显式 promote"""
+        state = self.state()
+        if not state["previous"]:
+            raise ValueError("没有可回滚的模型版本")
+        state["active"] = state["previous"].pop(0)
+        state["rolled_back_at"] = datetime.now().isoformat(timespec="seconds")
+        self._write_state(state)
+        logging.info(f"模型已回滚: {self.root} -> {state['active']}")
+        return state["active"]
+
+    def prune(self):
+        """删除超出保留数量、且未被激活/候选/回滚记录引用的旧版本"""
+        state = self.state()
+        pinned = {state["active"], state["candidate"], *state["previous"]}
+        unpinned = [v for v in self.versions() if v not in pinned]
+        for version in unpinned[:max(len(unpinned) - MODEL_KEEP_VERSIONS, 0)]:
+            shutil.rmtree(os.path.join(self.versions_dir, version), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    # 用法: python model_registry.py <list|promote|rollback> <instance> [version] [--data-dir DIR]
+    # 未指定 --data-dir 时按环境变量（AIOPS_DIR / AIOPS_SHARD_*）定位本节点的数据目录，
+    # 分片部署时需先加载 aiops.env：set -a; . /opt/monitoring/aiops/aiops.env; set +a
+    parser = argparse.ArgumentParser(description="AIOps 模型注册表管理")
+    parser.add_argument("command", choices=["list", "promote", "rollback"])
+    parser.add_argument("instance")
+    parser.add_argument("version", nargs="?")
+    parser.add_argument("--data-dir", help="分片数据目录，如 /opt/monitoring/aiops/shards/<id>")
+    args = parser.parse_args()
+
+    if args.data_dir is None:
+        shard = ShardConfig()
+        if not shard.owns(args.instance):
+            print(f"{args.instance} 归属分片 {shard.ring.owner(args.instance)}，请在该节点上执行或指定 --data-dir")
+            sys.exit(1)
+    registry = ModelRegistry.for_instance(args.instance, args.data_dir)
+    if not os.path.isdir(registry.versions_dir):
+        print(f"未找到 {args.instance} 的模型: {registry.root}")
+        sys.exit(1)
+
+    try:
+        if args.command == "list":
+            state = registry.state()
+            for v in registry.versions():
+                tag = "active" if v == state["active"] else "candidate" if v == state["candidate"] else ""
+                print(f"{v}\t{tag}")
+            if state.get("rolled_back_at"):
+                print(f"已于 {state['rolled_back_at']} 回滚，自动激活已暂停，执行 promote 后恢复")
+        elif args.command == "promote":
+            print(registry.promote(args.version))
+        else:
+            print(registry.rollback())
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Prometheus 查询结果缓存
+按规范化 PromQL + 按 step 对齐的时间桶缓存即时查询与区间查询结果，
+区间查询只拉取缺失的时间段，按字节数限制内存占用（即时查询按 LRU 整条淘汰，
+区间查询从最旧的时间桶开始淘汰），可选落盘持久化
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+import requests
+
+# === 配置 ===
+CACHE_STEP = int(os.getenv("PROM_CACHE_STEP", "300"))  # 时间桶宽度（秒），与检测周期一致
+CACHE_MAX_BYTES = int(os.getenv("PROM_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))  # 按序列化后的字节数计
+CACHE_LIVE_TTL = int(os.getenv("PROM_CACHE_LIVE_TTL", "30"))  # 实时边缘数据的有效期（秒）
+CACHE_LIVE_WINDOW = int(os.getenv("PROM_CACHE_LIVE_WINDOW", "120"))  # 距当前多久以内视为实时边缘（秒）
+CACHE_RETENTION = int(os.getenv("PROM_CACHE_RETENTION", "86400"))  # 区间查询缓存保留的时间跨度（秒）
+
+_STRING_LITERAL = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|`[^`]*`)')
+
+
+def normalize_query(query):
+    """规范化 PromQL：去除字符串字面量以外的多余空白"""
+    parts = _STRING_LITERAL.split(query.strip())
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            normalized.append(part)  # 字符串字面量原样保留
+        else:
+            part = re.sub(r"\s+", " ", part)
+            part = re.sub(r"\s*([(){}\[\],=!~<>+\-*/^%])\s*", r"\1", part)
+            normalized.append(part)
+    return "".join(normalized)
+
+
+def align(ts, step):
+    """将时间戳向下对齐到 step 边界"""
+    return int(ts // step) * step
+
+
+class PromQueryCache:
+    """Prometheus 查询缓存，对外提供 query / query_range 两个接口"""
+
+    def __init__(self, prometheus_url, step=CACHE_STEP, max_bytes=CACHE_MAX_BYTES,
+                 live_ttl=CACHE_LIVE_TTL, live_window=CACHE_LIVE_WINDOW, retention=CACHE_RETENTION,
+                 cache_file=None, stats_file=None, timeout=10):
+        self.prometheus_url = prometheus_url
+        self.step = step
+        self.max_bytes = max_bytes
+        self.live_ttl = live_ttl
+        self.live_window = live_window
+        self.retention = retention
+        self.cache_file = cache_file
+        self.stats_file = stats_file
+        self.timeout = timeout
+
+        self._entries = OrderedDict()  # key -> entry，按最近使用排序
+        self._sizes = {}
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "partial_hits": 0, "evictions": 0, "fetched_points": 0}
+        self._window_start = None  # 最近一次区间查询的起点，早于它的时间桶已不在当前工作集中
+        self._warned = False
+
+        if self.cache_file:
+            self.load()
+
+    # --- 即时查询 ---
+
+    def query(self, query, ts=None):
+        """即时查询，查询时间对齐到 step 桶，同一桶内的重复查询直接命中缓存"""
+        now = time.time()
+        bucket = align(now if ts is None else ts, self.step)
+        key = f"instant|{normalize_query(query)}|{bucket}"
+
+        entry = self._get(key, now)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry["result"]
+
+        self.stats["misses"] += 1
+        result = self._request("/api/v1/query", {"query": query, "time": bucket})
+        live = self._expiry(bucket, now) is not None
+        self._put(key, {
+            "result": result,
+            "expires": now + self.live_ttl if live else bucket + self.retention,
+            "live": live,
+        })
+        return result
+
+    # --- 区间查询 ---
+
+    def query_range(self, query, start, end, step=None):
+        """区间查询，只向 Prometheus 拉取缓存中缺失的时间段"""
+        now = time.time()
+        step = step or self.step
+        start, end = align(start, step), align(end, step)
+        key = f"range|{normalize_query(query)}|{step}"
+        self._window_start = start
+
+        entry = self._get(key, now) or {"covered": {}, "series": {}}
+        self._trim(entry, now)
+        covered = entry["covered"]
+
+        wanted = range(start, end + step, step)
+        missing = [t for t in wanted if str(t) not in covered]
+        if not missing:
+            self.stats["hits"] += 1
+        elif len(missing) < len(wanted):
+            self.stats["partial_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+
+        for seg_start, seg_end in self._segments(missing, step):
+            result = self._request("/api/v1/query_range", {
+                "query": query, "start": seg_start, "end": seg_end, "step": step,
+            })
+            for series in result:
+                labels = json.dumps(series["metric"], sort_keys=True)
+                values = entry["series"].setdefault(labels, {})
+                for t, v in series["values"]:
+                    values[str(int(t))] = v
+                    self.stats["fetched_points"] += 1
+            for t in range(seg_start, seg_end + step, step):
+                covered[str(t)] = self._expiry(t, now)
+
+        result = [
+            {
+                "metric": json.loads(labels),
+                "values": [[int(t), values[str(t)]] for t in wanted if str(t) in values],
+            }
+            for labels, values in entry["series"].items()
+            if any(str(t) in values for t in wanted)
+        ]
+        entry["expires"] = now + self.retention  # 长期未被使用的区间查询（如查询条件已变化）整体过期
+        self._put(key, entry)
+        return result
+
+    @staticmethod
+    def _segments(timestamps, step):
+        """把缺失的时间戳合并为连续区间"""
+        segments = []
+        for t in timestamps:
+            if segments and t - segments[-1][1] == step:
+                segments[-1][1] = t
+            else:
+                segments.append([t, t])
+        return [tuple(s) for s in segments]
+
+    def _trim(self, entry, now):
+        """丢弃已过期的实时边缘数据点，以及超出保留跨度的数据点"""
+        oldest = now - self.retention
+        self._remove_buckets(entry, {
+            t for t, exp in entry["covered"].items()
+            if (exp is not None and exp <= now) or int(t) < oldest
+        })
+
+    @staticmethod
+    def _remove_buckets(entry, buckets):
+        """从区间查询条目中删除指定时间桶的覆盖记录与数据点"""
+        for t in buckets:
+            entry["covered"].pop(t, None)
+        for labels in list(entry["series"]):
+            values = entry["series"][labels]
+            for t in [t for t in values if t in buckets]:
+                del values[t]
+            if not values:
+                del entry["series"][labels]
+
+    def _expiry(self, ts, now):
+        """稳定数据永不过期；实时边缘数据在 live_ttl 秒后过期"""
+        if ts >= now - self.live_window:
+            return now + self.live_ttl
+        return None
+
+    def _request(self, path, params):
+        resp = requests.get(f"{self.prometheus_url}{path}", params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()["data"]["result"]
+
+    # --- LRU ---
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry, now):
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    @staticmethod
+    def _expired(entry, now):
+        """即时查询结果的过期判断（实时边缘 live_ttl，稳定结果 retention）；区间查询按数据点单独过期"""
+        return entry.get("expires") is not None and entry["expires"] <= now
+
+    def _drop(self, key):
+        del self._entries[key]
+        self.total_bytes -= self._sizes.pop(key)
+
+    def _resize(self, key, entry):
+        # 以序列化后的大小计，与落盘文件大小一致
+        size = len(json.dumps([key, entry], separators=(",", ":")))
+        self.total_bytes += size - self._sizes.get(key, 0)
+        self._entries[key] = entry
+        self._sizes[key] = size
+
+    def _put(self, key, entry):
+        self._resize(key, entry)
+        self._entries.move_to_end(key)
+        if self.total_bytes > self.max_bytes:
+            self._evict(key)
+
+    def _evict(self, keep):
+        """
+        超出字节上限时先按 LRU 整条淘汰即时查询结果，再从所有区间查询中淘汰最旧的时间桶；
+        区间查询按固定顺序循环读取，整条淘汰会让每个条目都挤掉下一个要用的条目，命中率降为零，
+        按时间桶淘汰时下一轮只需补拉被淘汰的最旧几个时间桶
+        """
+        for key in [k for k, e in self._entries.items() if "covered" not in e and k != keep]:
+            if self.total_bytes <= self.max_bytes:
+                return
+            self._drop(key)
+            self.stats["evictions"] += 1
+
+        while self.total_bytes > self.max_bytes:
+            # 按条目内各时间桶平均分摊估算每个时间桶的字节数，一次确定需要淘汰到哪个时间桶
+            bucket_bytes = {}
+            for key, entry in self._entries.items():
+                if entry.get("covered"):
+                    share = self._sizes[key] / len(entry["covered"])
+                    for t in entry["covered"]:
+                        bucket_bytes[int(t)] = bucket_bytes.get(int(t), 0) + share
+            if not bucket_bytes:
+                return
+
+            excess, freed = self.total_bytes - self.max_bytes, 0
+            for cutoff in sorted(bucket_bytes):
+                freed += bucket_bytes[cutoff]
+                if freed >= excess:
+                    break
+            if self._window_start is not None and cutoff >= self._window_start and not self._warned:
+                logging.warning(
+                    f"Prometheus 缓存容量不足: 本轮查询的数据超过 PROM_CACHE_MAX_BYTES={self.max_bytes}，"
+                    f"下一轮需要重新拉取被淘汰的时间段"
+                )
+                self._warned = True
+
+            for key, entry in list(self._entries.items()):
+                if "covered" not in entry:
+                    continue
+                stale = {t for t in entry["covered"] if int(t) <= cutoff}
+                if not stale:
+                    continue
+                self._remove_buckets(entry, stale)
+                self.stats["evictions"] += len(stale)
+                if entry["covered"]:
+                    self._resize(key, entry)
+                else:
+                    self._drop(key)
+
+    # --- 持久化 ---
+
+    def load(self):
+        """从磁盘加载缓存与累计计数，跳过已过期的条目"""
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.warning(f"Prometheus 缓存加载失败: {self.cache_file} ({e})")
+            return
+        now = time.time()
+        for key, entry in data.get("entries", {}).items():
+            if self._expired(entry, now):
+                continue
+            if "covered" in entry:
+                self._trim(entry, now)
+            self._put(key, entry)
+        self.stats.update(data.get("stats", {}))
+
+    def save(self):
+        """原子写入缓存文件与统计文件；已过期条目先清除，实时边缘的即时查询结果不落盘"""
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if self._expired(e, now)]:
+            self._drop(key)
+        if self.cache_file:
+            data = {
+                "entries": {k: e for k, e in self._entries.items() if not e.get("live")},
+                "stats": self.stats,
+            }
+            self._atomic_write(self.cache_file, data)
+        if self.stats_file:
+            self._atomic_write(self.stats_file, dict(self.stats, bytes=self.total_bytes, entries=len(self._entries)))
+
+    @staticmethod
+    def _atomic_write(path, data):
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.warning(f"Prometheus 缓存写入失败: {path} ({e})")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+AIOps 检测分片
+按 instance 标签做一致性哈希，把被监控实例集合分摊到多个检测节点，
+成员列表为配置中的静态列表，成员变化时只有最少的实例改变归属。
+各节点只向 Prometheus 查询本分片的实例（PromQL instance 匹配器），状态只保存在本机：历史数据由 Prometheus 区间查询重建，
+模型由新归属节点重新训练，不再归属本节点的实例状态会被删除
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sys
+from urllib.parse import quote, unquote
+
+# === 配置 ===
+AIOPS_DIR = os.getenv("AIOPS_DIR", "/opt/monitoring/aiops")
+SHARD_MEMBERS = [m.strip() for m in os.getenv("AIOPS_SHARD_MEMBERS", "").split(",") if m.strip()]
+SHARD_ID = os.getenv("AIOPS_SHARD_ID", "")
+SHARD_VNODES = int(os.getenv("AIOPS_SHARD_VNODES", "128"))  # 每个成员的虚拟节点数
+
+_RE2_SPECIAL = re.compile(r"([\\.+*?()|\[\]{}^$])")  # Prometheus 正则（RE2）的元字符
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def instance_key(instance):
+    """把 instance 标签编码为可用作文件名、且可逆不冲突的键"""
+    if not instance:
+        return "%"  # quote 不会产生单独的 "%"
+    key = quote(instance, safe="")
+    return key if key.strip(".") else key.replace(".", "%2E")
+
+
+def instance_from_key(key):
+    """instance_key 的逆变换"""
+    return "" if key == "%" else unquote(key)
+
+
+class HashRing:
+    """带虚拟节点的一致性哈希环"""
+
+    def __init__(self, members, vnodes=SHARD_VNODES):
+        if not members:
+            raise ValueError("分片成员列表不能为空")
+        self.members = sorted(set(members))
+        self.vnodes = vnodes
+        self._ring = sorted(
+            (_hash(f"{member}#{i}"), member)
+            for member in self.members
+            for i in range(vnodes)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    def owner(self, instance):
+        """返回负责该 instance 的成员"""
+        idx = bisect.bisect(self._points, _hash(instance)) % len(self._ring)
+        return self._ring[idx][1]
+
+    def shard(self, instances, member):
+        """返回 instances 中归属 member 的子集"""
+        return [i for i in instances if self.owner(i) == member]
+
+
+class ShardConfig:
+    """当前检测节点的分片配置；未配置成员列表时退化为单节点，拥有全部实例"""
+
+    def __init__(self, members=None, shard_id=None, aiops_dir=AIOPS_DIR):
+        self.members = SHARD_MEMBERS if members is None else members
+        self.shard_id = SHARD_ID if shard_id is None else shard_id
+        self.aiops_dir = aiops_dir
+        self.enabled = bool(self.members)
+
+        if self.enabled:
+            if self.shard_id not in self.members:
+                raise ValueError(f"AIOPS_SHARD_ID={self.shard_id!r} 不在成员列表 {self.members} 中")
+            self.ring = HashRing(self.members)
+        else:
+            self.ring = None
+
+    def data_dir(self, member=None):
+        """成员的数据目录；单节点模式下沿用 AIOps 根目录"""
+        if not self.enabled:
+            return self.aiops_dir
+        return os.path.join(self.aiops_dir, "shards", member or self.shard_id)
+
+    def owns(self, instance):
+        return not self.enabled or self.ring.owner(instance) == self.shard_id
+
+    def filter(self, instances):
+        return [i for i in instances if self.owns(i)]
+
+    def matcher(self, instances):
+        """
+        本分片实例的 PromQL 标签匹配器，用于把分片过滤下推到查询中；
+        单节点模式下匹配全部实例，本分片没有实例时返回 None
+        """
+        if not self.enabled:
+            return 'instance!=""'
+        owned = sorted(self.filter(instances))  # 排序保证查询文本稳定，便于缓存复用
+        if not owned:
+            return None
+        pattern = "|".join(_RE2_SPECIAL.sub(r"\\\1", i) for i in owned)
+        return 'instance=~"' + pattern.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def release(self, subdir):
+        """
+        删除本节点数据目录 subdir 下已归属其他成员的实例状态（成员变化后的再平衡），
+        避免孤立状态长期残留，也避免归属切换回来时复用过期状态；返回被删除的实例列表
+        """
+        if not self.enabled:
+            return []
+
+        released = []
+        local_dir = os.path.join(self.data_dir(), subdir)
+        if not os.path.isdir(local_dir):
+            return released
+        for name in os.listdir(local_dir):
+            instance = instance_from_key(name)
+            if self.owns(instance):
+                continue
+            path = os.path.join(local_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            logging.info(f"分片再平衡: {instance} 已归属 {self.ring.owner(instance)}，删除本节点的 {subdir} 状态")
+            released.append(instance)
+        return released
+
+
+if __name__ == "__main__":
+    # 用法: python sharding.py <instance> [<instance> ...]
+    # 按 AIOPS_SHARD_MEMBERS 打印每个实例归属的成员
+    ring = HashRing(SHARD_MEMBERS or ["local"])
+    for inst in sys.argv[1:]:
+        print(f"{inst}\t{ring.owner(inst)}")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Prometheus 查询缓存本地测试
+用桩函数替换 requests.get 模拟 Prometheus，验证缺失区间合并、实时边缘过期、
+部分命中只补拉缺失时间段，以及超出字节上限时按时间桶淘汰后缓存仍然有效
+"""
+
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "ansible" / "roles" / "aiops" / "files"))
+
+import prom_cache  # noqa: E402
+from prom_cache import PromQueryCache, align  # noqa: E402
+
+STEP = 300
+WINDOW = 200  # 与检测器的 MAX_HISTORY 一致
+QUERIES = [f"metric_{i}" for i in range(4)]  # 与检测器每轮的 4 个区间查询一致
+
+
+class FakeResponse:
+    def __init__(self, result):
+        self.result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"data": {"result": self.result}}
+
+
+class FakePrometheus:
+    """记录每次请求的桩 Prometheus，每个查询返回 instances 个序列"""
+
+    def __init__(self, instances=20):
+        self.instances = [f"host{i}:9100" for i in range(instances)]
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append(params)
+        if url.endswith("/query_range"):
+            ts = range(int(params["start"]), int(params["end"]) + params["step"], params["step"])
+            return FakeResponse([
+                {"metric": {"instance": i}, "values": [[t, str(t % 97 + n)] for t in ts]}
+                for n, i in enumerate(self.instances)
+            ])
+        return FakeResponse([{"metric": {"instance": i}, "value": [params["time"], "1"]} for i in self.instances])
+
+
+class WarningCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def stable_end():
+    """距当前足够远、不属于实时边缘且在保留跨度内的窗口终点"""
+    return align(time.time() - 3600, STEP)
+
+
+def run_ticks(cache, prom, end, ticks):
+    """模拟连续多轮检测，每轮对 4 个查询各做一次窗口区间查询，返回每轮拉取的数据点数"""
+    fetched = []
+    for tick in range(ticks):
+        before = cache.stats["fetched_points"]
+        tick_end = end + tick * STEP
+        for query in QUERIES:
+            result = cache.query_range(query, tick_end - STEP * (WINDOW - 1), tick_end)
+            if len(result) != len(prom.instances) or any(len(s["values"]) != WINDOW for s in result):
+                raise AssertionError(f"{query} 返回的数据不完整")
+        fetched.append(cache.stats["fetched_points"] - before)
+    return fetched
+
+
+def check(condition, ok, fail):
+    print(f"✅ {ok}" if condition else f"❌ {fail}")
+    return condition
+
+
+def test_segments():
+    segments = PromQueryCache._segments([0, 300, 600, 1200, 1500, 2400], 300)
+    return check(segments == [(0, 600), (1200, 1500), (2400, 2400)],
+                 "缺失时间桶合并为连续区间", f"缺失区间合并错误: {segments}")
+
+
+def test_live_edge():
+    cache = PromQueryCache("http://prom", step=STEP, live_ttl=30, live_window=2 * STEP)
+    now = time.time()
+    end = align(now, STEP)
+    cache.query_range("up", end - 4 * STEP, end)
+    entry = cache._entries[f"range|up|{STEP}"]
+    cache._trim(entry, now + 31)
+    covered = sorted(int(t) for t in entry["covered"])
+    expected = [t for t in range(end - 4 * STEP, end + STEP, STEP) if t < now - cache.live_window]
+    return check(covered == expected and
+                 all(set(values) == {str(t) for t in expected} for values in entry["series"].values()),
+                 "实时边缘数据在 live_ttl 后过期，稳定数据保留", f"实时边缘过期错误: {covered} != {expected}")
+
+
+def test_partial_hit(prom):
+    cache = PromQueryCache("http://prom", step=STEP)
+    end = stable_end()
+    prom.requests.clear()
+    cache.query_range("up", end - 9 * STEP, end)
+    cache.query_range("up", end - 8 * STEP, end + STEP)
+    second = prom.requests[1]
+    ok = check(len(prom.requests) == 2 and second["start"] == second["end"] == end + STEP,
+               "部分命中只补拉缺失的时间桶", f"部分命中请求错误: {prom.requests}")
+    ok &= check(cache.stats["misses"] == 1 and cache.stats["partial_hits"] == 1,
+                "区间查询命中计数正确", f"区间查询计数错误: {cache.stats}")
+    cache.query_range("up", end - 8 * STEP, end + STEP)
+    return ok & check(len(prom.requests) == 2 and cache.stats["hits"] == 1,
+                      "重复区间查询完全命中", f"重复区间查询仍然请求了 Prometheus: {prom.requests[2:]}")
+
+
+def test_instant(prom):
+    cache = PromQueryCache("http://prom", step=STEP)
+    ts = stable_end()
+    prom.requests.clear()
+    cache.query("up", ts)
+    cache.query("up", ts + STEP - 1)  # 同一时间桶
+    ok = check(len(prom.requests) == 1 and prom.requests[0]["time"] == ts,
+               "同一时间桶内的即时查询命中缓存", f"即时查询缓存错误: {prom.requests}")
+
+    cache = PromQueryCache("http://prom", step=STEP, live_ttl=0, live_window=10 * STEP)
+    prom.requests.clear()
+    cache.query("up")
+    cache.query("up")
+    return ok & check(len(prom.requests) == 2, "实时边缘的即时查询结果过期后重新查询",
+                      f"实时边缘即时查询没有过期: {prom.requests}")
+
+
+def test_eviction(prom):
+    end = stable_end()
+    working_set = PromQueryCache("http://prom", step=STEP)
+    run_ticks(working_set, prom, end, 1)
+    size = working_set.total_bytes
+    full = len(QUERIES) * len(prom.instances) * WINDOW
+
+    # 上限略大于一轮的工作集：被淘汰的只是窗口外的旧时间桶，每轮只拉取最新时间桶
+    cache = PromQueryCache("http://prom", step=STEP, max_bytes=int(size * 1.01))
+    fetched = run_ticks(cache, prom, end, 4)
+    ok = check(fetched[1:] == [len(QUERIES) * len(prom.instances)] * 3 and cache.total_bytes <= cache.max_bytes,
+               f"上限略大于工作集时每轮只拉取最新时间桶 (每轮 {fetched[1:]} 个数据点)",
+               f"按时间桶淘汰后仍在重复拉取: {fetched}")
+    ok &= check(cache.stats["misses"] == len(QUERIES) and cache.stats["evictions"] > 0,
+                "淘汰旧时间桶后后续轮次没有完全未命中", f"出现完全未命中: {cache.stats}")
+
+    # 上限小于工作集：告警，仍有部分命中，只补拉被淘汰的时间段
+    collector = WarningCollector()
+    logging.getLogger().addHandler(collector)
+    try:
+        cache = PromQueryCache("http://prom", step=STEP, max_bytes=size // 2)
+        fetched = run_ticks(cache, prom, end, 3)
+    finally:
+        logging.getLogger().removeHandler(collector)
+    ok &= check(any("缓存容量不足" in m for m in collector.messages), "工作集超过上限时输出告警", "工作集超过上限时没有告警")
+    return ok & check(all(f < full for f in fetched[1:]) and cache.stats["partial_hits"] > 0,
+                      f"工作集超过上限时仍部分命中 (每轮 {fetched} / {full} 个数据点)",
+                      f"工作集超过上限时命中率降为零: {fetched}")
+
+
+def run_prom_cache_test():
+    print("🧪 开始 Prometheus 缓存测试...")
+    prom = FakePrometheus()
+    prom_cache.requests.get = prom.get
+
+    results = [
+        test_segments(),
+        test_live_edge(),
+        test_partial_hit(prom),
+        test_instant(prom),
+        test_eviction(prom),
+    ]
+    if not all(results):
+        return False
+    print("\n🎉 Prometheus 缓存测试完成!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_prom_cache_test() else 1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+AIOps 分片本地测试
+启动多个本地进程模拟多个检测节点（每个进程使用独立的数据目录，等同于不同主机），
+验证一致性哈希分片、成员变化时的最少归属变化、下推到 PromQL 的分片匹配器，
+以及不再归属本节点的状态被清理
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+AIOPS_FILES = Path(__file__).parent.parent / "ansible" / "roles" / "aiops" / "files"
+INSTANCES = [f"10.0.{i // 256}.{i % 256}:9100" for i in range(500)] + ["h0:9100", "h0_9100", 'h"1(x)']
+sys.path.insert(0, str(AIOPS_FILES))
+
+from sharding import ShardConfig  # noqa: E402
+
+# 子进程：清理已归属其他节点的模型目录，为本节点实例写入模型目录，输出本分片的实例
+WORKER = """
+import json, os, sys
+sys.path.insert(0, sys.argv[1])
+from sharding import ShardConfig, instance_key
+shard = ShardConfig()
+instances = json.loads(sys.stdin.read())
+released = shard.release("models")
+owned = shard.filter(instances)
+for instance in owned:
+    os.makedirs(os.path.join(shard.data_dir(), "models", instance_key(instance)), exist_ok=True)
+print(json.dumps({"owned": owned, "released": released}))
+"""
+
+
+def run_workers(root, members):
+    """为每个成员启动一个进程，每个成员使用 root 下独立的 AIOPS_DIR，返回 {member: 结果}"""
+    processes = {}
+    for member in members:
+        env = dict(
+            os.environ,
+            AIOPS_DIR=os.path.join(root, member),
+            AIOPS_SHARD_MEMBERS=",".join(members),
+            AIOPS_SHARD_ID=member,
+        )
+        processes[member] = subprocess.Popen(
+            [sys.executable, "-c", WORKER, str(AIOPS_FILES)],
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+    results = {}
+    for member, process in processes.items():
+        out, _ = process.communicate(json.dumps(INSTANCES))
+        results[member] = json.loads(out)
+    return results
+
+
+def stored_instances(root, member):
+    """成员本地保存了模型目录的实例数"""
+    models_dir = os.path.join(root, member, "shards", member, "models")
+    return len(os.listdir(models_dir)) if os.path.isdir(models_dir) else 0
+
+
+def check_coverage(results):
+    """每个实例恰好归属一个成员"""
+    owned = [i for r in results.values() for i in r["owned"]]
+    return len(owned) == len(set(owned)) == len(INSTANCES)
+
+
+def check_matcher(members, results):
+    """各成员的 PromQL 匹配器恰好匹配本分片的实例"""
+    for member, r in results.items():
+        matcher = ShardConfig(members, member).matcher(INSTANCES)
+        pattern = json.loads(matcher[len("instance=~"):])  # PromQL 双引号字符串与 JSON 字符串转义一致
+        if [i for i in INSTANCES if re.fullmatch(pattern, i)] != [i for i in INSTANCES if i in r["owned"]]:
+            return False
+    return True
+
+
+def run_shard_test():
+    print("🧪 开始分片测试...")
+    with tempfile.TemporaryDirectory() as root:
+        members = ["worker-a", "worker-b", "worker-c"]
+        before = run_workers(root, members)
+        if not check_coverage(before):
+            print("❌ 分片覆盖不正确")
+            return False
+        for member, r in before.items():
+            print(f"  📦 {member}: {len(r['owned'])} 个实例")
+        print("✅ 3 个节点的分片互不重叠且覆盖全部实例")
+        if not check_matcher(members, before):
+            print("❌ PromQL 分片匹配器与分片结果不一致")
+            return False
+        print("✅ PromQL 分片匹配器只匹配本分片的实例")
+
+        members.append("worker-d")
+        after = run_workers(root, members)
+        if not check_coverage(after):
+            print("❌ 扩容后分片覆盖不正确")
+            return False
+        released = sum(len(r["released"]) for r in after.values())
+        print(f"  🔀 扩容到 4 个节点，{len(after['worker-d']['owned'])}/{len(INSTANCES)} 个实例改变归属")
+        if sorted(i for r in after.values() for i in r["released"]) != sorted(after["worker-d"]["owned"]):
+            print("❌ 改变归属的实例不全是新节点接管的实例")
+            return False
+        for member, r in after.items():
+            if stored_instances(root, member) != len(r["owned"]):
+                print(f"❌ {member} 保留了不属于本节点的状态")
+                return False
+        print(f"✅ 原节点删除了 {released} 个已转移实例的状态，各节点只保留本分片的状态")
+
+    print("\n🎉 分片测试完成!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_shard_test() else 1)
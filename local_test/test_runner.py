@@ -89,6 +89,24 @@ def test_health_endpoint():
         print(f"❌ 无法访问健康检查端点: {e}")
         return False
 
+def run_shard_test():
+    """运行分片测试"""
+    print("🔀 运行分片测试...")
+    process = subprocess.run([
+        sys.executable,
+        "shard_test.py"
+    ], cwd=Path(__file__).parent)
+    return process.returncode == 0
+
+def run_prom_cache_test():
+    """运行 Prometheus 查询缓存测试"""
+    print("🗄️ 运行 Prometheus 查询缓存测试...")
+    process = subprocess.run([
+        sys.executable,
+        "prom_cache_test.py"
+    ], cwd=Path(__file__).parent)
+    return process.returncode == 0
+
 def run_full_test():
     """运行完整测试"""
     print("🧪 开始完整测试流程...")
@@ -165,6 +183,8 @@ def show_help():
     print("  check       检查依赖")
     print("  generate    生成测试数据")
     print("  detect      运行异常检测")
+    print("  shard       运行多进程分片测试")
+    print("  cache       运行 Prometheus 查询缓存测试")
     print("  help        显示帮助")
     print("\n示例:")
     print("  python test_runner.py test")
@@ -187,6 +207,10 @@ def main():
     elif command == "detect":
         if check_dependencies():
             run_anomaly_detection()
+    elif command == "shard":
+        run_shard_test()
+    elif command == "cache":
+        run_prom_cache_test()
     elif command == "help":
         show_help()
     else: